@@ -2,6 +2,8 @@
 定制的 Keras 层用于解码 SSD 的预测输出, 对应于原始 Caffe 实现 SSD 的 `DetectionOutput` 层.
 '''
 
+from collections import OrderedDict
+
 import numpy as np
 import tensorflow as tf
 import keras.backend as K
@@ -9,6 +11,93 @@ from keras.engine.topology import InputSpec
 from keras.engine.topology import Layer
 
 
+def _decode_boxes(tail, scale):
+    '''
+    将预测的相对于 Anchor 的偏置转换为 'corners' 格式的边界框, 坐标的顺序为 `(ymin, xmin, ymax, xmax)`,
+    也就是 `tf.image.combined_non_max_suppression()` 需要的顺序.
+
+    `tail` 是模型输出的最后 12 个通道, 形状为 `(batch_size, n_boxes, 12)`, 依次为 `(cx, cy, w, h)` 的预测偏置,
+    Anchor 和 variances. 结果最后再乘以 `(ymin, xmin, ymax, xmax)` 的缩放系数 `scale`.
+    由 `DecodeDetections` 使用 XLA 编译, exp, 乘法, 加减法和坐标顺序的调换会被融合为一个 kernel.
+    '''
+    pred_box, anchor, variance = tf.split(tail, num_or_size_splits=3, axis=-1)
+    centers = pred_box[...,:2] * variance[...,:2] * anchor[...,2:] + anchor[...,:2] # (cx, cy) = (cx, cy)_pred * variance * (w, h)_anchor + (cx, cy)_anchor
+    sizes = tf.exp(pred_box[...,2:] * variance[...,2:]) * anchor[...,2:] # (w, h) = exp((w, h)_pred * variance) * (w, h)_anchor
+    centers = tf.reverse(centers, axis=[-1]) # (cx, cy) -> (cy, cx)
+    sizes = tf.reverse(sizes, axis=[-1]) # (w, h) -> (h, w)
+    return tf.concat(values=[centers - 0.5 * sizes, centers + 0.5 * sizes], axis=-1) * scale
+
+
+_compiled_nms_kernel = None
+
+def _get_nms_kernel():
+    '''
+    第一次调用时导入 `numba` 并编译 `decode_numpy()` 使用的 NMS kernel, 以后直接返回编译好的函数.
+    只有 `decode_numpy()` 需要 `numba`, 构造模型时不需要导入它.
+    '''
+    global _compiled_nms_kernel
+    if _compiled_nms_kernel is None:
+        try:
+            from numba import njit, prange
+        except ImportError:
+            raise ImportError("`decode_numpy()` 需要 'numba' 模块.")
+
+        @njit(parallel=True, fastmath=True)
+        def nms_kernel(scores, xmin, ymin, xmax, ymax, confidence_thresh, iou_threshold, max_output_size, output):
+            '''
+            `DecodeDetections.decode_numpy()` 使用的概率阈值筛选和每一个类别的 non-maximum suppression.
+
+            `scores` 的形状为 `(batch_size, n_boxes, n_classes - 1)`, 不包含背景类别. 边界框的坐标按照
+            SoA (structure of arrays) 的格式分别存放在 `xmin`, `ymin`, `xmax`, `ymax` 中, 形状都是 `(batch_size, n_boxes)`.
+            结果写入全为 0 的 `output`, 形状为 `(batch_size, n_classes - 1, max_output_size, 6)`, 最后一个维度为
+            `[类别标签, 概率, xmin, ymin, xmax, ymax]`, 每一个类别的结果按照概率从大到小排列.
+
+            每一个 (图像, 类别) 组合是一个独立的任务, 并行执行. 已经保留的边界框的坐标也以 SoA 的格式连续存放,
+            这样计算 IoU 的内层循环可以被编译器向量化.
+            '''
+            batch_size, n_boxes, n_classes = scores.shape
+            for task in prange(batch_size * n_classes):
+                b = task // n_classes
+                c = task % n_classes
+                class_scores = scores[b, :, c]
+                candidates = np.nonzero(class_scores > confidence_thresh)[0]
+                order = candidates[np.argsort(-class_scores[candidates])]
+
+                kept_xmin = np.empty(max_output_size, dtype=xmin.dtype)
+                kept_ymin = np.empty(max_output_size, dtype=xmin.dtype)
+                kept_xmax = np.empty(max_output_size, dtype=xmin.dtype)
+                kept_ymax = np.empty(max_output_size, dtype=xmin.dtype)
+                n_kept = 0
+                for i in order:
+                    if n_kept == max_output_size:
+                        break
+                    area = (xmax[b, i] - xmin[b, i]) * (ymax[b, i] - ymin[b, i])
+                    max_iou = 0.0
+                    for j in range(n_kept):
+                        w = max(min(xmax[b, i], kept_xmax[j]) - max(xmin[b, i], kept_xmin[j]), 0.0)
+                        h = max(min(ymax[b, i], kept_ymax[j]) - max(ymin[b, i], kept_ymin[j]), 0.0)
+                        intersection = w * h
+                        union = area + (kept_xmax[j] - kept_xmin[j]) * (kept_ymax[j] - kept_ymin[j]) - intersection
+                        if union > 0.0:
+                            max_iou = max(max_iou, intersection / union)
+                    if max_iou > iou_threshold:
+                        continue
+                    kept_xmin[n_kept] = xmin[b, i]
+                    kept_ymin[n_kept] = ymin[b, i]
+                    kept_xmax[n_kept] = xmax[b, i]
+                    kept_ymax[n_kept] = ymax[b, i]
+                    output[b, c, n_kept, 0] = c + 1
+                    output[b, c, n_kept, 1] = class_scores[i]
+                    output[b, c, n_kept, 2] = xmin[b, i]
+                    output[b, c, n_kept, 3] = ymin[b, i]
+                    output[b, c, n_kept, 4] = xmax[b, i]
+                    output[b, c, n_kept, 5] = ymax[b, i]
+                    n_kept += 1
+
+        _compiled_nms_kernel = nms_kernel
+    return _compiled_nms_kernel
+
+
 class DecodeDetections(Layer):
     '''
     定制的 Keras 层用于解码 SSD 的预测输出.
@@ -66,13 +155,20 @@ class DecodeDetections(Layer):
         self.nms_max_output_size = nms_max_output_size
 
         # TensorFlow 需要这些常数.
-        self.tf_confidence_thresh = tf.constant(self.confidence_thresh, name='confidence_thresh')
-        self.tf_iou_threshold = tf.constant(self.iou_threshold, name='iou_threshold')
         self.tf_top_k = tf.constant(self.top_k, name='top_k')
-        self.tf_normalize_coords = tf.constant(self.normalize_coords, name='normalize_coords')
-        self.tf_img_height = tf.constant(self.img_height, dtype=tf.float32, name='img_height')
-        self.tf_img_width = tf.constant(self.img_width, dtype=tf.float32, name='img_width')
-        self.tf_nms_max_output_size = tf.constant(self.nms_max_output_size, name='nms_max_output_size')
+
+        # `normalize_coords` 在构造时就确定了, 直接把是否转换为绝对坐标的选择固定为一个 `(ymin, xmin, ymax, xmax)` 的缩放系数.
+        if self.normalize_coords:
+            self._scale = tf.constant([self.img_height, self.img_width, self.img_height, self.img_width], dtype=tf.float32, name='scale')
+        else:
+            self._scale = tf.constant([1.0, 1.0, 1.0, 1.0], dtype=tf.float32, name='scale')
+
+        # 边界框解码用 XLA 编译. 在构造这一层时才创建, 只导入这个模块 (例如 `mode='training'`) 时不需要 `experimental_compile`.
+        self._decode_boxes = tf.function(_decode_boxes, experimental_compile=True)
+
+        # 按输入形状 `(n_boxes, n_classes + 12)` 缓存的 `tf.function`, 最多保留 `_max_decode_fns` 个, 最近最少使用的先被删除.
+        self._decode_fns = OrderedDict()
+        self._max_decode_fns = 8
 
         super(DecodeDetections, self).__init__(**kwargs)
 
@@ -86,149 +182,144 @@ class DecodeDetections(Layer):
             3 维tensor, 形状 `(batch_size, top_k, 6)`. 第二维度包含 `top_k` 个预测值.
             最后一个维度包含如下值`[类别便签, 概率, xmin, ymin, xmax, ymax]`.
         '''
+        n_boxes, last_axis = y_pred.shape.as_list()[1:]
+        return self._get_decode_fn(n_boxes, last_axis)(y_pred)
+
+    def _get_decode_fn(self, n_boxes, last_axis):
+        '''
+        返回输入形状为 `(batch_size, n_boxes, last_axis)` 时使用的 `tf.function`.
+
+        每一个形状只 trace 一次得到静态的图, 在 eager 模式下调用时也不需要为每一个小的操作付出
+        Python 调度的开销. `n_boxes` 和 `last_axis` 作为静态形状写进 `input_signature`, 图中的
+        切片和形状都可以在 trace 的时候确定. 形状未知时 (`None`) 得到的是通用的版本.
+        '''
+        key = (n_boxes, last_axis)
+        decode_fn = self._decode_fns.pop(key, None)
+        if decode_fn is None:
+            decode_fn = tf.function(self._decode,
+                                    input_signature=[tf.TensorSpec(shape=[None, n_boxes, last_axis], dtype=tf.float32)])
+            if len(self._decode_fns) >= self._max_decode_fns:
+                self._decode_fns.popitem(last=False)
+        self._decode_fns[key] = decode_fn
+        return decode_fn
+
+    def _decode(self, y_pred):
+        '''
+        `call()` 的实现, 由 `_get_decode_fn()` 包装为 `tf.function`.
+        '''
 
         #####################################################################################
         # 1. 将边界框坐标从预测的相对于 Anchor 的偏置, 转换为绝对值坐标
         #####################################################################################
 
-        # 从相对于 Anchor 的偏置转换为相对于输入图像的偏置
-        cx = y_pred[...,-12] * y_pred[...,-4] * y_pred[...,-6] + y_pred[...,-8] # cx = cx_pred * cx_variance * w_anchor + cx_anchor
-        cy = y_pred[...,-11] * y_pred[...,-3] * y_pred[...,-5] + y_pred[...,-7] # cy = cy_pred * cy_variance * h_anchor + cy_anchor
-        w = tf.exp(y_pred[...,-10] * y_pred[...,-2]) * y_pred[...,-6] # w = exp(w_pred * variance_w) * w_anchor
-        h = tf.exp(y_pred[...,-9] * y_pred[...,-1]) * y_pred[...,-5] # h = exp(h_pred * variance_h) * h_anchor
-
-        # 将坐标格式从 'centroids' 转为 'corners'.
-        xmin = cx - 0.5 * w
-        ymin = cy - 0.5 * h
-        xmax = cx + 0.5 * w
-        ymax = cy + 0.5 * h
-
-        # 如果模型的输出边界是相对于图像尺寸的相对值, 而且我们希望转为绝对尺寸, 需要如下转换
-        def normalized_coords():
-            xmin1 = tf.expand_dims(xmin * self.tf_img_width, axis=-1)
-            ymin1 = tf.expand_dims(ymin * self.tf_img_height, axis=-1)
-            xmax1 = tf.expand_dims(xmax * self.tf_img_width, axis=-1)
-            ymax1 = tf.expand_dims(ymax * self.tf_img_height, axis=-1)
-            return xmin1, ymin1, xmax1, ymax1
-        def non_normalized_coords():
-            return tf.expand_dims(xmin, axis=-1), tf.expand_dims(ymin, axis=-1), tf.expand_dims(xmax, axis=-1), tf.expand_dims(ymax, axis=-1)
-
-        xmin, ymin, xmax, ymax = tf.cond(self.tf_normalize_coords, normalized_coords, non_normalized_coords)
-
-        # 将预测的 one-hot 编码的类别概率和边界框的坐标合并产生预测输出的 tensor
-        y_pred = tf.concat(values=[y_pred[...,:-12], xmin, ymin, xmax, ymax], axis=-1)
+        # 从相对于 Anchor 的偏置转换为相对于输入图像的偏置, 并将坐标格式从 'centroids' 转为 'corners'.
+        # 如果模型的输出边界是相对于图像尺寸的相对值, 而且我们希望转为绝对尺寸, 还需要乘以图像尺寸.
+        boxes = self._decode_boxes(y_pred[...,-12:], self._scale)
 
         #####################################################################################
         # 2. 使用类别概率阈值筛选边界框, 进行每一个类别的 non-maximum suppression, 最后选择 top-k 个边界框.
         #####################################################################################
 
-        batch_size = tf.shape(y_pred)[0] # 输出类型: tf.int32
-        n_boxes = tf.shape(y_pred)[1]
-        n_classes = y_pred.shape[2] - 4
-        class_indices = tf.range(1, n_classes)
-
-        # 创建一个函数, 筛选预测的边界框, 完成如下任务:
-        # - 类别概率阈值筛选边界框
-        # - non-maximum suppression (NMS)
-        # - top-k 筛选
-        def filter_predictions(batch_item):
-
-            # 创建一个函数, 用于单个类别的边界框的筛选
-            def filter_single_class(index):
-
-                # 从一个形状为 (n_boxes, n_classes + 4 coordinates) 的 tensor 提取一个 
-                # 形状为 (n_boxes, 1 + 4 coordinates) 的 tensor. 提取的 tensor 只包含
-                # index 指定的类别的概率值
-                confidences = tf.expand_dims(batch_item[..., index], axis=-1)
-                class_id = tf.fill(dims=tf.shape(confidences), value=tf.to_float(index))
-                box_coordinates = batch_item[...,-4:]
-
-                single_class = tf.concat([class_id, confidences, box_coordinates], axis=-1)
-
-                # 在 `index` 指定的类别上面做筛选
-                threshold_met = single_class[:,1] > self.tf_confidence_thresh
-                single_class = tf.boolean_mask(tensor=single_class,
-                                               mask=threshold_met)
-
-                # NMS.
-                def perform_nms():
-                    scores = single_class[...,1]
-
-                    # 函数 `tf.image.non_max_suppression()` 需要边界框的格式为 `(ymin, xmin, ymax, xmax)`.
-                    xmin = tf.expand_dims(single_class[...,-4], axis=-1)
-                    ymin = tf.expand_dims(single_class[...,-3], axis=-1)
-                    xmax = tf.expand_dims(single_class[...,-2], axis=-1)
-                    ymax = tf.expand_dims(single_class[...,-1], axis=-1)
-                    boxes = tf.concat(values=[ymin, xmin, ymax, xmax], axis=-1)
-
-                    maxima_indices = tf.image.non_max_suppression(boxes=boxes,
-                                                                  scores=scores,
-                                                                  max_output_size=self.tf_nms_max_output_size,
-                                                                  iou_threshold=self.iou_threshold,
-                                                                  name='non_maximum_suppresion')
-                    maxima = tf.gather(params=single_class,
-                                       indices=maxima_indices,
-                                       axis=0)
-                    return maxima
-
-                # 处理背景的情况
-                def no_confident_predictions():
-                    return tf.constant(value=0.0, shape=(1,6))
-
-                single_class_nms = tf.cond(tf.equal(tf.size(single_class), 0), no_confident_predictions, perform_nms)
-
-                # 确保 `single_class` 的元素个数为 `self.nms_max_output_size`
-                padded_single_class = tf.pad(tensor=single_class_nms,
-                                             paddings=[[0, self.tf_nms_max_output_size - tf.shape(single_class_nms)[0]], [0, 0]],
-                                             mode='CONSTANT',
-                                             constant_values=0.0)
-
-                return padded_single_class
-
-            # 在所有的类别上面 `filter_single_class()` 
-            filtered_single_classes = tf.map_fn(fn=lambda i: filter_single_class(i),
-                                                elems=tf.range(1,n_classes),
-                                                dtype=tf.float32,
-                                                parallel_iterations=128,
-                                                back_prop=False,
-                                                swap_memory=False,
-                                                infer_shape=True,
-                                                name='loop_over_classes')
-
-            # 将筛选后的所有类别的结果拼接为一个 tensor.
-            filtered_predictions = tf.reshape(tensor=filtered_single_classes, shape=(-1,6))
-
-            # 进行 top-k 的筛选, 如果余下的边界框的数量不足 ‘top_k', 则填充到 ‘top_k'. 使得产生的tensor
-            # 长度为 `self.top_k`. 
-            def top_k():
-                return tf.gather(params=filtered_predictions,
-                                 indices=tf.nn.top_k(filtered_predictions[:, 1], k=self.tf_top_k, sorted=True).indices,
-                                 axis=0)
-            def pad_and_top_k():
-                padded_predictions = tf.pad(tensor=filtered_predictions,
-                                            paddings=[[0, self.tf_top_k - tf.shape(filtered_predictions)[0]], [0, 0]],
-                                            mode='CONSTANT',
-                                            constant_values=0.0)
-                return tf.gather(params=padded_predictions,
-                                 indices=tf.nn.top_k(padded_predictions[:, 1], k=self.tf_top_k, sorted=True).indices,
-                                 axis=0)
-
-            top_k_boxes = tf.cond(tf.greater_equal(tf.shape(filtered_predictions)[0], self.tf_top_k), top_k, pad_and_top_k)
-
-            return top_k_boxes
-
-        # 对同一个 batch 的所有图像进行 `filter_predictions()` 
-        output_tensor = tf.map_fn(fn=lambda x: filter_predictions(x),
-                                  elems=y_pred,
-                                  dtype=None,
-                                  parallel_iterations=128,
-                                  back_prop=False,
-                                  swap_memory=False,
-                                  infer_shape=True,
-                                  name='loop_over_batch')
+        # `tf.image.combined_non_max_suppression()` 在一个操作中完成整个 batch 所有类别的概率阈值筛选,
+        # non-maximum suppression 和 top-k 筛选. 它需要边界框的格式为 `(ymin, xmin, ymax, xmax)`,
+        # 形状为 `(batch_size, n_boxes, 1, 4)`, 即所有的类别共享同一组边界框.
+        boxes = tf.expand_dims(boxes, axis=2)
+        # 去掉背景类别的概率, 形状为 `(batch_size, n_boxes, n_classes - 1)`
+        scores = y_pred[...,:-12][...,1:]
+
+        # 坐标可能是绝对坐标, 不能被截断到 [0,1] 之间, 所以 `clip_boxes=False`.
+        nmsed_boxes, nmsed_scores, nmsed_classes, valid_detections = tf.image.combined_non_max_suppression(
+            boxes=boxes,
+            scores=scores,
+            max_output_size_per_class=self.nms_max_output_size,
+            max_total_size=self.top_k,
+            iou_threshold=self.iou_threshold,
+            score_threshold=self.confidence_thresh,
+            clip_boxes=False,
+            name='combined_non_maximum_suppresion')
+
+        # 背景类别已经被去掉了, 所以类别标签需要加 1. 不足 `top_k` 个边界框时, 填充的部分全部为 0.
+        valid_mask = tf.sequence_mask(valid_detections, maxlen=self.top_k, dtype=tf.float32)
+        class_ids = tf.expand_dims((nmsed_classes + 1.0) * valid_mask, axis=-1)
+        confidences = tf.expand_dims(nmsed_scores, axis=-1)
+
+        # 将边界框的格式从 `(ymin, xmin, ymax, xmax)` 转回 `(xmin, ymin, xmax, ymax)`
+        nmsed_boxes = tf.gather(nmsed_boxes, [1, 0, 3, 2], axis=-1)
+
+        output_tensor = tf.concat(values=[class_ids, confidences, nmsed_boxes], axis=-1)
 
         return output_tensor
 
+    def decode_numpy(self, y_pred):
+        '''
+        和 `call()` 相同的解码, 但是不经过 TensorFlow, 使用 NumPy 和 Numba 在 CPU 上完成.
+        在 CPU 上推理, 而且 batch 较小的时候, TensorFlow 调度大量小操作的开销占主要部分, 这时可以用这个方法
+        对 `mode='training'` 的模型的输出直接解码. 需要安装 `numba`.
+
+        Arguments:
+            y_pred (array): 形状为 `(batch_size, n_boxes, n_classes + 12)` 的 Numpy 数组.
+
+        Returns:
+            Numpy 数组, 形状 `(batch_size, top_k, 6)`, 格式和 `call()` 的输出一样.
+        '''
+        nms_kernel = _get_nms_kernel()
+
+        y_pred = np.asarray(y_pred, dtype=np.float32)
+        batch_size = y_pred.shape[0]
+
+        # 从相对于 Anchor 的偏置转换为 'corners' 格式的绝对坐标, 整个 batch 一次完成.
+        pred_box, anchor, variance = np.split(y_pred[...,-12:], 3, axis=-1)
+        centers = pred_box[...,:2] * variance[...,:2] * anchor[...,2:] + anchor[...,:2]
+        sizes = np.exp(pred_box[...,2:] * variance[...,2:]) * anchor[...,2:]
+        boxes = np.concatenate([centers - 0.5 * sizes, centers + 0.5 * sizes], axis=-1)
+        if self.normalize_coords:
+            boxes *= np.array([self.img_width, self.img_height, self.img_width, self.img_height], dtype=np.float32)
+
+        # 去掉背景类别的概率, 进行每一个类别的 non-maximum suppression.
+        scores = np.ascontiguousarray(y_pred[...,1:-12])
+        nms_output = np.zeros((batch_size, scores.shape[-1], self.nms_max_output_size, 6), dtype=np.float32)
+        nms_kernel(scores,
+                   np.ascontiguousarray(boxes[...,0]),
+                   np.ascontiguousarray(boxes[...,1]),
+                   np.ascontiguousarray(boxes[...,2]),
+                   np.ascontiguousarray(boxes[...,3]),
+                   self.confidence_thresh,
+                   self.iou_threshold,
+                   self.nms_max_output_size,
+                   nms_output)
+
+        # 在所有的类别中选择 top-k 个, 不足 `top_k` 个的部分填充为 0. 先用 `np.argpartition` 选出 top-k 个,
+        # 只对这 `top_k` 个排序, 不需要对所有类别的输出 (其中大部分是填充的 0) 全部排序.
+        nms_output = nms_output.reshape(batch_size, -1, 6)
+        if nms_output.shape[1] < self.top_k:
+            nms_output = np.pad(nms_output, [(0, 0), (0, self.top_k - nms_output.shape[1]), (0, 0)], mode='constant')
+        top_k_indices = np.argpartition(-nms_output[...,1], kth=self.top_k - 1, axis=1)[:,:self.top_k]
+        top_k_order = np.argsort(-np.take_along_axis(nms_output[...,1], top_k_indices, axis=1), axis=1, kind='stable')
+        top_k_indices = np.take_along_axis(top_k_indices, top_k_order, axis=1)
+        return np.take_along_axis(nms_output, np.expand_dims(top_k_indices, axis=-1), axis=1)
+
+    def export_saved_model(self, path, batch_size, n_boxes, n_classes):
+        '''
+        将这一层的解码过程单独导出为 SavedModel, 用于部署.
+
+        部署时输入的形状和这一层的参数都是固定的, 所以用完全确定的输入形状 trace 一次 `call()` 的实现,
+        `top_k`, 各个阈值和缩放系数都作为常数写进图中, 加载以后不再需要 Python 代码, 也没有动态形状.
+        在 TensorFlow 1.x 中需要先启用 eager execution.
+
+        Arguments:
+            path (str): SavedModel 保存的目录.
+            batch_size (int): 输入的 batch size.
+            n_boxes (int): 每一幅图像预测的边界框的个数.
+            n_classes (int): 包括背景类别在内的类别个数, 模型输出的最后一个维度为 `n_classes + 12`.
+
+        Returns:
+            None.
+        '''
+        module = tf.Module()
+        module.decode = tf.function(self._decode,
+                                    input_signature=[tf.TensorSpec(shape=[batch_size, n_boxes, n_classes + 12], dtype=tf.float32, name='y_pred')])
+        tf.saved_model.save(module, path, signatures=module.decode.get_concrete_function())
+
     def compute_output_shape(self, input_shape):
         batch_size, n_boxes, last_axis = input_shape
         return (batch_size, self.tf_top_k, 6) # 最后一个维度: (类别标签, 类别概率, 边界框的 4 个坐标)
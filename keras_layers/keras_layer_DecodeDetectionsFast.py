@@ -68,13 +68,13 @@ class DecodeDetectionsFast(Layer):
         self.nms_max_output_size = nms_max_output_size
 
         # TensorFlow 需要这些常数.
-        self.tf_confidence_thresh = tf.constant(self.confidence_thresh, name='confidence_thresh')
-        self.tf_iou_threshold = tf.constant(self.iou_threshold, name='iou_threshold')
         self.tf_top_k = tf.constant(self.top_k, name='top_k')
-        self.tf_normalize_coords = tf.constant(self.normalize_coords, name='normalize_coords')
-        self.tf_img_height = tf.constant(self.img_height, dtype=tf.float32, name='img_height')
-        self.tf_img_width = tf.constant(self.img_width, dtype=tf.float32, name='img_width')
-        self.tf_nms_max_output_size = tf.constant(self.nms_max_output_size, name='nms_max_output_size')
+
+        # `normalize_coords` 在构造时就确定了, 直接把是否转换为绝对坐标的选择固定为一个 `(xmin, ymin, xmax, ymax)` 的缩放系数.
+        if self.normalize_coords:
+            self._scale = tf.constant([self.img_width, self.img_height, self.img_width, self.img_height], dtype=tf.float32, name='scale')
+        else:
+            self._scale = tf.constant([1.0, 1.0, 1.0, 1.0], dtype=tf.float32, name='scale')
 
         super(DecodeDetectionsFast, self).__init__(**kwargs)
 
@@ -98,113 +98,66 @@ class DecodeDetectionsFast(Layer):
         # 提取每一个 Anchor 位置对应的最大的概率.
         confidences = tf.reduce_max(y_pred[...,:-12], axis=-1, keep_dims=True)
 
-        # 从相对于 Anchor 的偏置转换为相对于输入图像的偏置
-        cx = y_pred[...,-12] * y_pred[...,-4] * y_pred[...,-6] + y_pred[...,-8] # cx = cx_pred * cx_variance * w_anchor + cx_anchor
-        cy = y_pred[...,-11] * y_pred[...,-3] * y_pred[...,-5] + y_pred[...,-7] # cy = cy_pred * cy_variance * h_anchor + cy_anchor
-        w = tf.exp(y_pred[...,-10] * y_pred[...,-2]) * y_pred[...,-6] # w = exp(w_pred * variance_w) * w_anchor
-        h = tf.exp(y_pred[...,-9] * y_pred[...,-1]) * y_pred[...,-5] # h = exp(h_pred * variance_h) * h_anchor
-
-        # 将坐标格式从 'centroids' 转为 'corners'.
-        xmin = cx - 0.5 * w
-        ymin = cy - 0.5 * h
-        xmax = cx + 0.5 * w
-        ymax = cy + 0.5 * h
-
-        # 如果模型的输出边界是相对于图像尺寸的相对值, 而且我们希望转为绝对尺寸, 需要如下转换
-        def normalized_coords():
-            xmin1 = tf.expand_dims(xmin * self.tf_img_width, axis=-1)
-            ymin1 = tf.expand_dims(ymin * self.tf_img_height, axis=-1)
-            xmax1 = tf.expand_dims(xmax * self.tf_img_width, axis=-1)
-            ymax1 = tf.expand_dims(ymax * self.tf_img_height, axis=-1)
-            return xmin1, ymin1, xmax1, ymax1
-        def non_normalized_coords():
-            return tf.expand_dims(xmin, axis=-1), tf.expand_dims(ymin, axis=-1), tf.expand_dims(xmax, axis=-1), tf.expand_dims(ymax, axis=-1)
-
-        xmin, ymin, xmax, ymax = tf.cond(self.tf_normalize_coords, normalized_coords, non_normalized_coords)
+        # 从相对于 Anchor 的偏置转换为相对于输入图像的偏置. 最后 12 个通道只切片一次, 再分为预测偏置, Anchor 和 variances.
+        pred_box, anchor, variance = tf.split(y_pred[...,-12:], num_or_size_splits=3, axis=-1)
+        centers = pred_box[...,:2] * variance[...,:2] * anchor[...,2:] + anchor[...,:2] # (cx, cy) = (cx, cy)_pred * variance * (w, h)_anchor + (cx, cy)_anchor
+        sizes = tf.exp(pred_box[...,2:] * variance[...,2:]) * anchor[...,2:] # (w, h) = exp((w, h)_pred * variance) * (w, h)_anchor
+
+        # 将坐标格式从 'centroids' 转为 'corners', 得到形状为 `(batch_size, n_boxes, 4)` 的 `(xmin, ymin, xmax, ymax)`.
+        # 如果模型的输出边界是相对于图像尺寸的相对值, 而且我们希望转为绝对尺寸, 还需要乘以图像尺寸.
+        boxes = tf.concat(values=[centers - 0.5 * sizes, centers + 0.5 * sizes], axis=-1) * self._scale
 
         # 将预测的 one-hot 编码的类别概率和边界框的坐标合并产生预测输出的 tensor
-        y_pred = tf.concat(values=[class_ids, confidences, xmin, ymin, xmax, ymax], axis=-1)
+        y_pred = tf.concat(values=[class_ids, confidences, boxes], axis=-1)
 
         #####################################################################################
         # 2. 使用概率阈值筛选边界框, 进行每一个类别的 non-maximum suppression, 最后选择 top-k 个边界框.
         #####################################################################################
 
-        batch_size = tf.shape(y_pred)[0] # 输出类型: tf.int32
-        n_boxes = tf.shape(y_pred)[1]
-        n_classes = y_pred.shape[2] - 4
-        class_indices = tf.range(1, n_classes)
+        # 在整个 batch 上一次性准备好 NMS 的输入. 背景类别的边界框的概率置为 0, 会和概率不满足阈值的边界框一起
+        # 被 NMS 的 `score_threshold` 筛除. 函数 `tf.image.non_max_suppression_padded()` 需要边界框的格式为 `(ymin, xmin, ymax, xmax)`.
+        scores = y_pred[...,1] * tf.to_float(tf.not_equal(y_pred[...,0], 0.0))
+        boxes = tf.gather(boxes, [1, 0, 3, 2], axis=-1)
 
         # 创建一个函数, 筛选预测的边界框, 完成如下任务:
         # - 按照概率阈值筛选边界框
         # - non-maximum suppression (NMS)
         # - top-k 筛选
-        def filter_predictions(batch_item):
-
-            # 只保留非背景的边界框.
-            positive_boxes = tf.not_equal(batch_item[...,0], 0.0)
-            predictions = tf.boolean_mask(tensor=batch_item,
-                                          mask=positive_boxes)
-
-            def perform_confidence_thresholding():
-                # 按照概率筛选
-                threshold_met = predictions[:,1] > self.tf_confidence_thresh
-                return tf.boolean_mask(tensor=predictions,
-                                       mask=threshold_met)
-            def no_positive_boxes():
-                return tf.constant(value=0.0, shape=(1,6))
-
-            # 如果边界框的个数大于0, 按照概率进行筛选.
-            predictions_conf_thresh = tf.cond(tf.equal(tf.size(predictions), 0), no_positive_boxes, perform_confidence_thresholding)
-
-            def perform_nms():
-                scores = predictions_conf_thresh[...,1]
-
-                # 函数 `tf.image.non_max_suppression()` 需要边界框的格式为 `(ymin, xmin, ymax, xmax)`.
-                xmin = tf.expand_dims(predictions_conf_thresh[...,-4], axis=-1)
-                ymin = tf.expand_dims(predictions_conf_thresh[...,-3], axis=-1)
-                xmax = tf.expand_dims(predictions_conf_thresh[...,-2], axis=-1)
-                ymax = tf.expand_dims(predictions_conf_thresh[...,-1], axis=-1)
-                boxes = tf.concat(values=[ymin, xmin, ymax, xmax], axis=-1)
-
-                maxima_indices = tf.image.non_max_suppression(boxes=boxes,
-                                                              scores=scores,
-                                                              max_output_size=self.tf_nms_max_output_size,
-                                                              iou_threshold=self.iou_threshold,
-                                                              name='non_maximum_suppresion')
-                maxima = tf.gather(params=predictions_conf_thresh,
-                                   indices=maxima_indices,
-                                   axis=0)
-                return maxima
-            def no_confident_predictions():
-                return tf.constant(value=0.0, shape=(1,6))
-
-            # 进行 NMS.
-            predictions_nms = tf.cond(tf.equal(tf.size(predictions_conf_thresh), 0), no_confident_predictions, perform_nms)
-
-            # 进行 top-k 的筛选, 如果余下的边界框的数量不足 ‘top_k', 则填充到 ‘top_k'. 使得产生的tensor
-            # 长度为 `self.top_k`. 
-            def top_k():
-                return tf.gather(params=predictions_nms,
-                                 indices=tf.nn.top_k(predictions_nms[:, 1], k=self.tf_top_k, sorted=True).indices,
-                                 axis=0)
-            def pad_and_top_k():
-                padded_predictions = tf.pad(tensor=predictions_nms,
-                                            paddings=[[0, self.tf_top_k - tf.shape(predictions_nms)[0]], [0, 0]],
-                                            mode='CONSTANT',
-                                            constant_values=0.0)
-                return tf.gather(params=padded_predictions,
-                                 indices=tf.nn.top_k(padded_predictions[:, 1], k=self.tf_top_k, sorted=True).indices,
-                                 axis=0)
-
-            top_k_boxes = tf.cond(tf.greater_equal(tf.shape(predictions_nms)[0], self.tf_top_k), top_k, pad_and_top_k)
+        def filter_predictions(batch_item, batch_item_boxes, batch_item_scores):
+
+            # 概率阈值筛选在 NMS 中完成, 不需要先用 `tf.boolean_mask` 生成一个长度不定的 tensor, 也不需要处理它为空的情况.
+            # 输出的 `maxima_indices` 被填充到固定的长度 `nms_max_output_size`, 只有前 `valid_outputs` 个是有效的.
+            # 边界框不能单独转换为 bfloat16 以减少内存读写: NMS 的 op 要求 `boxes` 和 `scores` 是同一个 dtype, 而且只支持 float32 和 half.
+            maxima_indices, valid_outputs = tf.image.non_max_suppression_padded(boxes=batch_item_boxes,
+                                                                                scores=batch_item_scores,
+                                                                                max_output_size=self.nms_max_output_size,
+                                                                                iou_threshold=self.iou_threshold,
+                                                                                score_threshold=self.confidence_thresh,
+                                                                                pad_to_max_output_size=True,
+                                                                                name='non_maximum_suppresion')
+
+            # 进行 top-k 的筛选. NMS 输出的边界框已经按照概率从大到小排列, 直接取前 `top_k` 个就可以, 不需要再排序.
+            # `maxima_indices` 的长度为 `nms_max_output_size`, 截断或者填充为 `top_k`. 两个长度都是 Python 整数,
+            # 所以产生的 tensor 的形状是静态的, 不需要动态的 `tf.pad`.
+            if self.nms_max_output_size >= self.top_k:
+                top_k_indices = maxima_indices[:self.top_k]
+            else:
+                top_k_indices = tf.pad(tensor=maxima_indices, paddings=[[0, self.top_k - self.nms_max_output_size]])
+
+            # 填充的索引为 0, 用 `valid_outputs` 生成的 mask 将这些位置的值都置为 0.
+            valid_mask = tf.sequence_mask(valid_outputs, maxlen=self.top_k, dtype=tf.float32)
+            top_k_boxes = tf.gather(params=batch_item,
+                                    indices=top_k_indices,
+                                    axis=0) * tf.expand_dims(valid_mask, axis=-1)
 
             return top_k_boxes
 
-        # 对同一个 batch 的所有图像进行 `filter_predictions()` 
-        output_tensor = tf.map_fn(fn=lambda x: filter_predictions(x),
-                                  elems=y_pred,
-                                  dtype=None,
-                                  parallel_iterations=128,
+        # 对同一个 batch 的所有图像进行 `filter_predictions()`. 每一个同时执行的迭代都有自己的 NMS 中间结果,
+        # 同时执行的迭代太多只会占用更多的内存, 所以只允许少量的迭代同时执行.
+        output_tensor = tf.map_fn(fn=lambda x: filter_predictions(x[0], x[1], x[2]),
+                                  elems=(y_pred, boxes, scores),
+                                  dtype=tf.float32,
+                                  parallel_iterations=4,
                                   back_prop=False,
                                   swap_memory=False,
                                   infer_shape=True,
@@ -155,24 +155,27 @@ def decode_detections(y_pred,
 
     y_pred_decoded = [] # Store the final predictions in this list
     for batch_item in y_pred_decoded_raw: # `batch_item` has shape `[n_boxes, n_classes + 4 coords]`
-        pred = [] # Store the final predictions for this batch item here
-        for class_id in range(1, n_classes): # For each class except the background class (which has class ID 0)...
-            single_class = batch_item[:,[class_id, -4, -3, -2, -1]] # ...keep only the confidences for that class, making this an array of shape `[n_boxes, 5]` and...
-            threshold_met = single_class[single_class[:,0] > confidence_thresh] # ...keep only those boxes with a confidence above the set threshold.
-            if threshold_met.shape[0] > 0: # If any boxes made the threshold...
-                maxima = _greedy_nms(threshold_met, iou_threshold=iou_threshold, coords='corners', border_pixels=border_pixels) # ...perform NMS on them.
+        scores = batch_item[:,1:n_classes] # The confidences of all classes except the background class (which has class ID 0), an array of shape `[n_boxes, n_classes - 1]`
+        class_indices, box_indices = np.nonzero(scores.T > confidence_thresh) # Threshold all classes with a single mask. Going through the transposed mask yields the (box, class) pairs grouped by class.
+        if box_indices.shape[0] > 0: # If any boxes made the threshold...
+            candidates = np.empty((box_indices.shape[0], 5)) # ...make one row `[confidence, xmin, ymin, xmax, ymax]` per (box, class) pair that made the threshold...
+            candidates[:,0] = scores[box_indices, class_indices]
+            candidates[:,1:] = batch_item[box_indices, -4:]
+            class_starts = np.flatnonzero(np.diff(class_indices)) + 1 # ...find where the rows of each class begin...
+            pred = [] # Store the final predictions for this batch item here
+            for single_class, class_index in zip(np.split(candidates, class_starts), class_indices[np.r_[0, class_starts]]): # ...and for each class that has any rows...
+                maxima = _greedy_nms(single_class, iou_threshold=iou_threshold, coords='corners', border_pixels=border_pixels) # ...perform NMS on them.
                 maxima_output = np.zeros((maxima.shape[0], maxima.shape[1] + 1)) # Expand the last dimension by one element to have room for the class ID. This is now an arrray of shape `[n_boxes, 6]`
-                maxima_output[:,0] = class_id # Write the class ID to the first column...
+                maxima_output[:,0] = class_index + 1 # Write the class ID to the first column. `scores` has no background column, so the class ID is the column index plus one...
                 maxima_output[:,1:] = maxima # ...and write the maxima to the other columns...
                 pred.append(maxima_output) # ...and append the maxima for this class to the list of maxima for this batch item.
-        # Once we're through with all classes, keep only the `top_k` maxima with the highest scores
-        if pred: # If there are any predictions left after confidence-thresholding...
+            # Once we're through with all classes, keep only the `top_k` maxima with the highest scores
             pred = np.concatenate(pred, axis=0)
             if top_k != 'all' and pred.shape[0] > top_k: # If we have more than `top_k` results left at this point, otherwise there is nothing to filter,...
                 top_k_indices = np.argpartition(pred[:,1], kth=pred.shape[0]-top_k, axis=0)[pred.shape[0]-top_k:] # ...get the indices of the `top_k` highest-score maxima...
                 pred = pred[top_k_indices] # ...and keep only those entries of `pred`...
         else:
-            pred = np.array(pred) # Even if empty, `pred` must become a Numpy array.
+            pred = np.array([]) # Even if empty, `pred` must become a Numpy array.
         y_pred_decoded.append(pred) # ...and now that we're done, append the array of final predictions for this batch item to the output list
 
     return y_pred_decoded